@@ -17,6 +17,7 @@ import unittest
 import warnings
 import random
 import contextlib
+import shutil
 import socket
 import time
 from collections import OrderedDict
@@ -145,30 +146,53 @@ def suppress_warnings(fn):
     return wrapper
 
 
+# NB: only looks up the type objects; this doesn't initialize CUDA
+_tensor_type_names = ['DoubleTensor', 'FloatTensor', 'HalfTensor', 'LongTensor',
+                      'IntTensor', 'ShortTensor', 'CharTensor', 'ByteTensor']
+_cpu_types = {'torch.cuda.' + name: getattr(torch, name) for name in _tensor_type_names}
+_gpu_types = {'torch.' + name: getattr(torch.cuda, name) for name in _tensor_type_names}
+# get_gpu_type also accepts the CPU type objects themselves
+_gpu_types.update({getattr(torch, name): getattr(torch.cuda, name) for name in _tensor_type_names})
+
+
 def get_cpu_type(type_name):
-    module, name = type_name.rsplit('.', 1)
-    assert module == 'torch.cuda'
-    return getattr(torch, name)
+    try:
+        return _cpu_types[type_name]
+    except KeyError:
+        raise ValueError("{} is not a dense CUDA tensor type".format(type_name))
 
 
 def get_gpu_type(type_name):
-    if isinstance(type_name, type):
-        type_name = '{}.{}'.format(type_name.__module__, type_name.__name__)
-    module, name = type_name.rsplit('.', 1)
-    assert module == 'torch'
-    return getattr(torch.cuda, name)
+    try:
+        return _gpu_types[type_name]
+    except KeyError:
+        raise ValueError("{} is not a dense CPU tensor type".format(type_name))
+
+
+def _tensor_to_gpu(tensor, type_map):
+    # callers are expected to run this under torch.no_grad()
+    assert tensor.is_leaf
+    tensor_type = tensor.type()
+    res = tensor.clone().type(type_map.get(tensor_type, get_gpu_type(tensor_type)))
+    res.requires_grad = tensor.requires_grad
+    return res
 
 
 def to_gpu(obj, type_map={}):
     if isinstance(obj, torch.Tensor):
-        assert obj.is_leaf
-        t = type_map.get(obj.type(), get_gpu_type(obj.type()))
         with torch.no_grad():
-            res = obj.clone().type(t)
-            res.requires_grad = obj.requires_grad
-        return res
+            return _tensor_to_gpu(obj, type_map)
+    elif obj is None or isinstance(obj, Number) or isinstance(obj, string_classes):
+        # immutable, so there is nothing for deepcopy to do
+        return obj
     elif torch.is_storage(obj):
         return obj.new().resize_(obj.size()).copy_(obj)
+    elif isinstance(obj, (list, tuple)) and obj and all(isinstance(o, torch.Tensor) for o in obj):
+        # common case of a container of input tensors: convert them all in one
+        # no_grad block instead of recursing into to_gpu for each of them
+        with torch.no_grad():
+            res = [_tensor_to_gpu(o, type_map) for o in obj]
+        return res if isinstance(obj, list) else tuple(res)
     elif isinstance(obj, list):
         return [to_gpu(o, type_map) for o in obj]
     elif isinstance(obj, tuple):
@@ -177,8 +201,17 @@ def to_gpu(obj, type_map={}):
         return deepcopy(obj)
 
 
+_function_arglists = {}
+
+
 def get_function_arglist(func):
-    return inspect.getargspec(func).args
+    # key on the underlying function so that bound methods share an entry
+    # (their args, including self, are the same)
+    key = getattr(func, '__func__', func)
+    if key not in _function_arglists:
+        getargspec = inspect.getfullargspec if PY3 else inspect.getargspec
+        _function_arglists[key] = getargspec(key).args
+    return _function_arglists[key]
 
 
 def set_rng_seed(seed):
@@ -191,11 +224,21 @@ def set_rng_seed(seed):
 @contextlib.contextmanager
 def freeze_rng_state():
     rng_state = torch.get_rng_state()
-    if torch.cuda.is_available():
+    # Don't initialize the CUDA context just to stash its RNG state. If it
+    # isn't initialized yet, lazy init will seed the CUDA generators with the
+    # seed torch.manual_seed queued, which is what initial_seed() reports.
+    had_cuda = torch.cuda._initialized
+    if had_cuda:
         cuda_rng_state = torch.cuda.get_rng_state()
+    else:
+        seed = torch.initial_seed()
     yield
-    if torch.cuda.is_available():
+    if had_cuda:
         torch.cuda.set_rng_state(cuda_rng_state)
+    elif torch.cuda._initialized:
+        # CUDA was initialized inside the block; put the generators back in
+        # the state lazy init would have left them in.
+        torch.cuda.manual_seed_all(seed)
     torch.set_rng_state(rng_state)
 
 
@@ -207,6 +250,18 @@ def iter_indices(tensor):
     return product(*(range(s) for s in tensor.size()))
 
 
+_device_count = None
+
+
+def _cuda_device_count():
+    # NB: must not be called at import time, see the note at the top of
+    # this file.
+    global _device_count
+    if _device_count is None:
+        _device_count = torch.cuda.device_count()
+    return _device_count
+
+
 def is_iterable(obj):
     try:
         iter(obj)
@@ -224,14 +279,16 @@ class CudaMemoryLeakCheck():
         # when the test is the first to initialize those
         from common_cuda import initialize_cuda_context_rng
         initialize_cuda_context_rng()
+        self.num_devices = _cuda_device_count()
 
-    @staticmethod
-    def get_cuda_memory_usage():
+    def get_cuda_memory_usage(self, collect=True):
         # we don't need CUDA synchronize because the statistics are not tracked at
         # actual freeing, but at when marking the block as free.
-        num_devices = torch.cuda.device_count()
-        gc.collect()
-        return tuple(torch.cuda.memory_allocated(i) for i in range(num_devices))
+        if self.num_devices == 0:
+            return ()
+        if collect:
+            gc.collect()
+        return tuple(torch.cuda.memory_allocated(i) for i in range(self.num_devices))
 
     def __enter__(self):
         self.befores = self.get_cuda_memory_usage()
@@ -240,7 +297,11 @@ class CudaMemoryLeakCheck():
         # Don't check for leaks if an exception was thrown
         if exec_type is not None:
             return
-        afters = self.get_cuda_memory_usage()
+        # A full gc sweep is only needed when garbage may still be holding on
+        # to CUDA memory, i.e., when the usage doesn't already match.
+        afters = self.get_cuda_memory_usage(collect=False)
+        if afters != self.befores:
+            afters = self.get_cuda_memory_usage()
 
         for i, (before, after) in enumerate(zip(self.befores, afters)):
             if not TEST_WITH_ROCM:
@@ -254,6 +315,9 @@ class CudaMemoryLeakCheck():
                         self.name, after - before, i), RuntimeWarning)
 
 
+_cppop_regex = re.compile(r'CppOp\[(.+?)\]')
+
+
 class TestCase(expecttest.TestCase):
     precision = 1e-5
     maxDiff = None
@@ -296,8 +360,11 @@ class TestCase(expecttest.TestCase):
     def assertTensorsSlowEqual(self, x, y, prec=None, message=''):
         max_err = 0
         self.assertEqual(x.size(), y.size())
-        for index in iter_indices(x):
-            max_err = max(max_err, abs(x[index] - y[index]))
+        if x.numel() > 0:
+            diff = (x - y).abs()
+            if diff.is_floating_point():
+                diff[torch.isnan(x) | torch.isnan(y)] = 0
+            max_err = diff.max().item()
         self.assertLessEqual(max_err, prec, message)
 
     def genSparseTensor(self, size, sparse_dim, nnz, is_uncoalesced, device='cpu'):
@@ -333,7 +400,6 @@ class TestCase(expecttest.TestCase):
 
     def safeCoalesce(self, t):
         tc = t.coalesce()
-        self.assertEqual(tc.to_dense(), t.to_dense())
         self.assertTrue(tc.is_coalesced())
 
         # Our code below doesn't work when nnz is 0, because
@@ -343,22 +409,22 @@ class TestCase(expecttest.TestCase):
             self.assertEqual(t._values(), tc._values())
             return tc
 
-        value_map = {}
-        for idx, val in zip(t._indices().t(), t._values()):
-            idx_tup = tuple(idx.tolist())
-            if idx_tup in value_map:
-                value_map[idx_tup] += val
-            else:
-                value_map[idx_tup] = val.clone() if isinstance(val, torch.Tensor) else val
-
-        new_indices = sorted(list(value_map.keys()))
-        new_values = [value_map[idx] for idx in new_indices]
-        if t._values().ndimension() < 2:
-            new_values = t._values().new(new_values)
+        values = t._values()
+        if t.sparse_dim() == 0:
+            # All entries share the same (empty) index, so they collapse into
+            # one. unique(dim=0) can't handle the (nnz, 0) indices here.
+            new_indices = t._indices()[:, :1]
+            new_values = values.sum(0, keepdim=True)
         else:
-            new_values = torch.stack(new_values)
+            # unique over the columns of indices sorts them lexicographically,
+            # and inverse maps each original entry to the column it gets summed
+            # into. unique(dim=0) on CUDA loops over entries on the host, so
+            # run it on CPU and only move the inverse mapping back.
+            new_indices, inverse = torch.unique(t._indices().cpu().t(), sorted=True, return_inverse=True, dim=0)
+            new_indices = new_indices.t().to(values.device)
+            new_values = values.new_zeros((new_indices.size(1),) + values.shape[1:])
+            new_values.index_add_(0, inverse.to(values.device), values)
 
-        new_indices = t._indices().new(new_indices).t()
         tg = t.new(new_indices, new_values, t.size())
 
         self.assertEqual(tc._indices(), tg._indices())
@@ -370,6 +436,79 @@ class TestCase(expecttest.TestCase):
 
         return tg
 
+    def _assertEqualTensorNumber(self, x, y, prec, message, allow_inf):
+        self.assertEqual(x.item(), y, prec, message, allow_inf)
+
+    def _assertEqualNumberTensor(self, x, y, prec, message, allow_inf):
+        self.assertEqual(x, y.item(), prec, message, allow_inf)
+
+    def _assertEqualTensors(self, x, y, prec, message, allow_inf):
+        def assertTensorsEqual(a, b):
+            super(TestCase, self).assertEqual(a.size(), b.size(), message)
+            # fast path for exact matches; NaNs never compare equal, so
+            # those still go through the masked comparison below. Matching
+            # infs must be rejected unless allow_inf, which the comparison
+            # below does since inf - inf is NaN.
+            if (a.dtype == b.dtype and a.device == b.device and a.numel() > 0 and torch.equal(a, b) and
+                    (allow_inf or not a.is_floating_point() or not torch.isinf(a).any())):
+                return
+            if a.numel() > 0:
+                if b.dtype != a.dtype:
+                    b = b.to(dtype=a.dtype)
+                if b.device != a.device:
+                    b = b.to(device=a.device)
+                diff = a - b
+                # check that NaNs are in the same locations
+                if a.is_floating_point():
+                    nan_mask = a != a
+                    self.assertTrue(torch.equal(nan_mask, b != b), message)
+                    diff[nan_mask] = 0
+                # inf check if allow_inf=True
+                if allow_inf:
+                    inf_mask = (a == float("inf")) | (a == float("-inf"))
+                    self.assertTrue(torch.equal(inf_mask,
+                                                (b == float("inf")) | (b == float("-inf"))),
+                                    message)
+                    diff[inf_mask] = 0
+                # TODO: implement abs on CharTensor
+                if diff.is_signed() and 'CharTensor' not in diff.type():
+                    diff.abs_()
+                max_err = diff.max()
+                self.assertLessEqual(max_err, prec, message)
+        super(TestCase, self).assertEqual(x.is_sparse, y.is_sparse, message)
+        if x.is_sparse:
+            x = self.safeCoalesce(x)
+            y = self.safeCoalesce(y)
+            assertTensorsEqual(x._indices(), y._indices())
+            assertTensorsEqual(x._values(), y._values())
+        else:
+            assertTensorsEqual(x, y)
+
+    def _assertEqualNumbers(self, x, y, prec, message, allow_inf):
+        if abs(x) == inf or abs(y) == inf:
+            if allow_inf:
+                super(TestCase, self).assertEqual(x, y, message)
+            else:
+                self.fail("Expected finite numeric values - x={}, y={}".format(x, y))
+            return
+        super(TestCase, self).assertLessEqual(abs(x - y), prec, message)
+
+    # Exact (type(x), type(y)) matches for the most common assertEqual calls,
+    # so that they skip the isinstance chain below. Anything else, including
+    # subclasses, goes through the chain. Handlers are looked up by name so
+    # that overrides in subclasses apply on both paths.
+    _assert_equal_handlers = {
+        (torch.Tensor, torch.Tensor): '_assertEqualTensors',
+        (torch.Tensor, int): '_assertEqualTensorNumber',
+        (torch.Tensor, float): '_assertEqualTensorNumber',
+        (int, torch.Tensor): '_assertEqualNumberTensor',
+        (float, torch.Tensor): '_assertEqualNumberTensor',
+        (int, int): '_assertEqualNumbers',
+        (int, float): '_assertEqualNumbers',
+        (float, int): '_assertEqualNumbers',
+        (float, float): '_assertEqualNumbers',
+    }
+
     def assertEqual(self, x, y, prec=None, message='', allow_inf=False):
         if isinstance(prec, str) and message == '':
             message = prec
@@ -377,41 +516,15 @@ class TestCase(expecttest.TestCase):
         if prec is None:
             prec = self.precision
 
-        if isinstance(x, torch.Tensor) and isinstance(y, Number):
-            self.assertEqual(x.item(), y, prec, message, allow_inf)
+        handler = self._assert_equal_handlers.get((type(x), type(y)))
+        if handler is not None:
+            getattr(self, handler)(x, y, prec, message, allow_inf)
+        elif isinstance(x, torch.Tensor) and isinstance(y, Number):
+            self._assertEqualTensorNumber(x, y, prec, message, allow_inf)
         elif isinstance(y, torch.Tensor) and isinstance(x, Number):
-            self.assertEqual(x, y.item(), prec, message, allow_inf)
+            self._assertEqualNumberTensor(x, y, prec, message, allow_inf)
         elif isinstance(x, torch.Tensor) and isinstance(y, torch.Tensor):
-            def assertTensorsEqual(a, b):
-                super(TestCase, self).assertEqual(a.size(), b.size(), message)
-                if a.numel() > 0:
-                    b = b.type_as(a)
-                    b = b.cuda(device=a.get_device()) if a.is_cuda else b.cpu()
-                    # check that NaNs are in the same locations
-                    nan_mask = a != a
-                    self.assertTrue(torch.equal(nan_mask, b != b), message)
-                    diff = a - b
-                    diff[nan_mask] = 0
-                    # inf check if allow_inf=True
-                    if allow_inf:
-                        inf_mask = (a == float("inf")) | (a == float("-inf"))
-                        self.assertTrue(torch.equal(inf_mask,
-                                                    (b == float("inf")) | (b == float("-inf"))),
-                                        message)
-                        diff[inf_mask] = 0
-                    # TODO: implement abs on CharTensor
-                    if diff.is_signed() and 'CharTensor' not in diff.type():
-                        diff = diff.abs()
-                    max_err = diff.max()
-                    self.assertLessEqual(max_err, prec, message)
-            super(TestCase, self).assertEqual(x.is_sparse, y.is_sparse, message)
-            if x.is_sparse:
-                x = self.safeCoalesce(x)
-                y = self.safeCoalesce(y)
-                assertTensorsEqual(x._indices(), y._indices())
-                assertTensorsEqual(x._values(), y._values())
-            else:
-                assertTensorsEqual(x, y)
+            self._assertEqualTensors(x, y, prec, message, allow_inf)
         elif isinstance(x, string_classes) and isinstance(y, string_classes):
             super(TestCase, self).assertEqual(x, y, message)
         elif type(x) == set and type(y) == set:
@@ -430,13 +543,7 @@ class TestCase(expecttest.TestCase):
         elif isinstance(x, bool) and isinstance(y, bool):
             super(TestCase, self).assertEqual(x, y, message)
         elif isinstance(x, Number) and isinstance(y, Number):
-            if abs(x) == inf or abs(y) == inf:
-                if allow_inf:
-                    super(TestCase, self).assertEqual(x, y, message)
-                else:
-                    self.fail("Expected finite numeric values - x={}, y={}".format(x, y))
-                return
-            super(TestCase, self).assertLessEqual(abs(x - y), prec, message)
+            self._assertEqualNumbers(x, y, prec, message, allow_inf)
         else:
             super(TestCase, self).assertEqual(x, y, message)
 
@@ -519,7 +626,8 @@ class TestCase(expecttest.TestCase):
             warnings.simplefilter("always")  # allow any warning to be raised
             callable()
             self.assertTrue(len(ws) > 0, msg)
-            found = any(re.search(regex, str(w.message)) is not None for w in ws)
+            regex = re.compile(regex)
+            found = any(regex.search(str(w.message)) is not None for w in ws)
             self.assertTrue(found, msg)
 
     def assertExpected(self, s, subname=None):
@@ -580,8 +688,8 @@ class TestCase(expecttest.TestCase):
 
         # a hack for JIT tests
         if IS_WINDOWS:
-            expected = re.sub(r'CppOp\[(.+?)\]', 'CppOp[]', expected)
-            s = re.sub(r'CppOp\[(.+?)\]', 'CppOp[]', s)
+            expected = _cppop_regex.sub('CppOp[]', expected)
+            s = _cppop_regex.sub('CppOp[]', s)
 
         if expecttest.ACCEPT:
             if expected != s:
@@ -617,15 +725,29 @@ def download_file(url, binary=True):
 
     if os.path.exists(path):
         return path
+    # Stream into a temporary file and only move it into place once the
+    # download completed, so an interrupted download isn't reused later. The
+    # temporary file is per process so that concurrent test processes don't
+    # clash.
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
     try:
-        data = request.urlopen(url, timeout=15).read()
-        with open(path, 'wb' if binary else 'w') as f:
-            f.write(data)
+        with contextlib.closing(request.urlopen(url, timeout=15)) as response:
+            with open(tmp_path, 'wb' if binary else 'w') as f:
+                shutil.copyfileobj(response, f, 1 << 20)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # on Windows, rename fails if another process got there first
+            if not os.path.exists(path):
+                raise
         return path
     except error.URLError:
         msg = "could not download test file '{}'".format(url)
         warnings.warn(msg, RuntimeWarning)
         raise unittest.SkipTest(msg)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def find_free_port():
@@ -678,10 +800,8 @@ def random_square_matrix_of_rank(l, rank):
 
 def random_symmetric_matrix(l):
     A = torch.randn(l, l)
-    for i in range(l):
-        for j in range(i):
-            A[i, j] = A[j, i]
-    return A
+    U = A.triu()
+    return U + U.t() - torch.diag(A.diagonal())
 
 
 def random_symmetric_psd_matrix(l):
@@ -710,19 +830,17 @@ def random_fullrank_matrix_distinct_singular_value(l, *batches, **kwargs):
     if silent and not torch._C.has_lapack:
         return torch.ones(l, l)
 
+    s = torch.arange(1., l + 1).mul_(1.0 / (l + 1))
     if len(batches) == 0:
         A = torch.randn(l, l)
         u, _, v = A.svd()
-        s = torch.arange(1., l + 1).mul_(1.0 / (l + 1))
         return u.mm(torch.diag(s)).mm(v.t())
     else:
-        all_matrices = []
-        for _ in range(0, torch.prod(torch.as_tensor(batches)).item()):
-            A = torch.randn(l, l)
-            u, _, v = A.svd()
-            s = torch.arange(1., l + 1).mul_(1.0 / (l + 1))
-            all_matrices.append(u.mm(torch.diag(s)).mm(v.t()))
-        return torch.stack(all_matrices).reshape(*(batches + (l, l)))
+        # svd only takes matrices, but the reconstruction can be batched
+        all_svds = [torch.randn(l, l).svd() for _ in range(torch.prod(torch.as_tensor(batches)).item())]
+        u = torch.stack([u for u, _, _ in all_svds])
+        v = torch.stack([v for _, _, v in all_svds])
+        return (u * s).matmul(v.transpose(-2, -1)).reshape(*(batches + (l, l)))
 
 
 def do_test_dtypes(self, dtypes, layout, device):